@@ -1,13 +1,20 @@
 import os
+import re
 import json
+import time
+import hashlib
+import tempfile
+import contextlib
 from pathlib import Path
-from datetime import date, datetime, timedelta
+from datetime import date, datetime
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
 
 import gspread
+from gspread.utils import DateTimeOption, ValueRenderOption
 from google.oauth2.service_account import Credentials
 
 
@@ -47,6 +54,9 @@ def _get_setting(key: str, default: str = "") -> str:
 
 SHEET_ID = _get_setting("GOOGLE_SHEET_ID", "")
 TAB_NAME = _get_setting("GOOGLE_SHEET_TAB", "trips")
+# Only these columns are downloaded (A1 notation, e.g. "A:C" or "B1:E").
+# Set GOOGLE_SHEET_RANGE to widen it if start_date/end_date/note live further right.
+SHEET_RANGE = _get_setting("GOOGLE_SHEET_RANGE", "A:C")
 DEFAULT_APPLICATION_DATE_STR = _get_setting("DEFAULT_APPLICATION_DATE", "")  # optional
 
 # Local credentials file path (do NOT rely on this in Streamlit Cloud)
@@ -78,8 +88,34 @@ def safe_parse_date(s) -> date | None:
     return None
 
 
+# Google Sheets serial day numbers count from 30/12/1899.
+# Only serials for 01/01/1900 ... 11/04/2262 are treated as dates: pandas 2.x parses
+# into datetime64[ns], which can't go later than that (see MIN/MAX_TRIP_DATE).
+SHEETS_EPOCH = "1899-12-30"
+SHEETS_SERIAL_RANGE = (2, 132320)
+
+
+def parse_date_series(col: pd.Series) -> pd.Series:
+    """
+    Vectorized safe_parse_date(): numeric cells in the Sheets date-serial range are dates,
+    text cells use the same accepted formats. Anything else (checkboxes, other numbers,
+    unparseable text) becomes NaT.
+    """
+    # One pass over cell types. Exact type matches, so checkbox bools aren't numbers
+    # and digits typed as text aren't serials.
+    kinds = col.map(type)
+    numbers = pd.to_numeric(col.where(kinds.isin([int, float])), errors="coerce")
+    serials = numbers.where(numbers.between(*SHEETS_SERIAL_RANGE))
+    parsed = pd.to_datetime(np.floor(serials), unit="D", origin=SHEETS_EPOCH, errors="coerce")
+
+    text = col.where(kinds.eq(str), "").str.strip()
+    parsed = parsed.fillna(pd.to_datetime(text, format="%Y-%m-%d", errors="coerce"))
+    return parsed.fillna(pd.to_datetime(text, format="%d/%m/%Y", errors="coerce"))
+
+
 def uk_fmt(d: date) -> str:
-    return d.strftime("%d/%m/%Y")
+    # DD/MM/YYYY without going through strftime
+    return f"{d.day:02d}/{d.month:02d}/{d.year:04d}"
 
 
 def years_ago(d: date, years: int) -> date:
@@ -102,68 +138,145 @@ def one_year_ago(d: date) -> date:
 # Only WHOLE days abroad count: exclude day you leave AND day you return.
 # Abroad days are those strictly between (leave, return).
 # ----------------------------
-def whole_days_abroad(leave: date, ret: date) -> int:
-    if ret <= leave:
-        return 0
+def _as_days(d) -> np.ndarray:
+    """
+    date / Timestamp / datetime64, scalar or array-like -> datetime64[D].
+    """
+    return np.asarray(d, dtype="datetime64[D]")
+
+
+# Day numbers count from here. int32 covers millions of years either side,
+# so trip columns stay half the width of int64 epoch days.
+DAY_ZERO = np.datetime64("2000-01-01", "D")
+
+
+# Trips outside these dates are dropped at ingest; every day number and day count
+# derived from them fits in int32. The upper bound is the last whole day datetime64[ns]
+# can hold, so pandas 2.x and 3.x accept exactly the same trips.
+MIN_TRIP_DATE = pd.Timestamp("1900-01-01")
+MAX_TRIP_DATE = pd.Timestamp("2262-04-11")
+
+
+def _to_int32(a) -> np.ndarray:
+    """
+    astype("int32") wraps silently on overflow; refuse instead.
+    """
+    a = np.asarray(a, dtype="int64")
+    info = np.iinfo(np.int32)
+    if a.size and (a.min() < info.min or a.max() > info.max):
+        raise OverflowError("Date arithmetic out of int32 range.")
+    return a.astype("int32")
+
+
+def _as_day_numbers(d) -> np.ndarray:
+    """
+    Dates (scalar or array-like) -> int32 days since DAY_ZERO: the integer space all absence kernels work in.
+    """
+    return _to_int32((_as_days(d) - DAY_ZERO).astype("int64"))
+
+
+def _day_number(d) -> int:
+    return int(_as_day_numbers(d))
+
+
+def whole_days_abroad(leave, ret) -> int | np.ndarray:
+    """
+    Accepts single dates or whole date columns (returns an int array then).
+    """
     # leave=1st, return=2nd => (2-1)-1 = 0 whole days abroad
-    return max(0, (ret - leave).days - 1)
+    days = np.maximum(0, (_as_days(ret) - _as_days(leave)).astype("int64") - 1)
+    return int(days) if days.ndim == 0 else days
 
 
-def countable_interval(leave: date, ret: date) -> tuple[date, date] | None:
+def countable_interval(leave, ret) -> tuple[np.ndarray, np.ndarray]:
     """
-    The days that count as 'abroad' are: leave+1 ... ret-1 (inclusive).
+    The days that count as 'abroad' are: leave+1 ... ret-1 (inclusive), as day numbers.
+    Empty (end < start) when there are no whole days abroad.
     """
-    start = leave + timedelta(days=1)
-    end = ret - timedelta(days=1)
-    if end < start:
-        return None
-    return start, end
+    return _as_day_numbers(leave) + 1, _as_day_numbers(ret) - 1
 
 
-def interval_overlap(a_start: date, a_end: date, b_start: date, b_end: date) -> tuple[date, date] | None:
-    s = max(a_start, b_start)
-    e = min(a_end, b_end)
-    if e < s:
-        return None
-    return s, e
+# ----------------------------
+# Absence index: sorted countable-interval endpoints + prefix sums,
+# so each window query is a few binary searches instead of a scan over all trips.
+# ----------------------------
+def build_absence_index(cs: np.ndarray, ce: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    cs/ce: the _cs/_ce columns of a trips DataFrame.
+    """
+    keep = ce >= cs  # trips with no whole days abroad never contribute
+    # Trips from load_trips_df are already oldest-first, so this stable sort is cheap,
+    # but searchsorted below must not depend on the caller's ordering
+    order = np.argsort(cs[keep], kind="stable")
+    cs, ce_by_start = cs[keep][order], ce[keep][order]
+    ce = np.sort(ce_by_start)
+    return {
+        "cstart": cs,
+        "cend": ce,
+        # Prefix sums can outgrow int32, so accumulate in int64
+        "cstart_cumsum": np.concatenate(([0], np.cumsum(cs, dtype="int64"))),
+        "cend_cumsum": np.concatenate(([0], np.cumsum(ce, dtype="int64"))),
+        # Latest countable end among the trips started so far, for the presence check (handles overlapping trips)
+        "cend_runmax": np.maximum.accumulate(ce_by_start) if len(ce_by_start) else ce_by_start,
+    }
+
+
+def _absent_days_up_to(index: dict[str, np.ndarray], t: int) -> int:
+    """
+    Whole days abroad on or before day number t, summed over all trips:
+    every trip started by t contributes (t - cstart + 1), minus (t - cend) for those already over.
+    """
+    a = int(np.searchsorted(index["cstart"], t, side="right"))
+    b = int(np.searchsorted(index["cend"], t, side="left"))
+    started = a * (t + 1) - int(index["cstart_cumsum"][a])
+    finished = b * t - int(index["cend_cumsum"][b])
+    return started - finished
 
 
-def count_absences_in_window(trips: pd.DataFrame, window_start: date, window_end: date) -> int:
+def count_absences_in_windows(
+    index: dict[str, np.ndarray], window_starts: tuple[date, ...], window_end: date
+) -> tuple[int, ...]:
     """
-    Count WHOLE days abroad (per Form AN) that fall within [window_start, window_end] inclusive.
+    Several windows sharing one end date (e.g. 12 months and 5 years before application):
+    the days-abroad total up to window_end is looked up once and reused for every start.
     """
-    total = 0
-    for _, r in trips.iterrows():
-        leave = r["start_date"]
-        ret = r["end_date"]
-        if not isinstance(leave, date) or not isinstance(ret, date):
-            continue
+    we = _day_number(window_end)
+    up_to_end = _absent_days_up_to(index, we)
 
-        ci = countable_interval(leave, ret)
-        if ci is None:
-            continue
-        cs, ce = ci
+    counts = []
+    for window_start in window_starts:
+        ws = _day_number(window_start)
+        counts.append(up_to_end - _absent_days_up_to(index, ws - 1) if ws <= we else 0)
+    return tuple(counts)
 
-        ov = interval_overlap(cs, ce, window_start, window_end)
-        if ov is None:
-            continue
 
-        os_, oe_ = ov
-        total += (oe_ - os_).days + 1  # inclusive
-    return total
+def is_in_uk_on_day(index: dict[str, np.ndarray], d: date) -> bool:
+    """
+    Under 'whole days abroad', they are abroad on day d iff (leave < d < return),
+    i.e. d is inside some countable interval. Among trips whose countable interval
+    starts on or before d, check whether any of them is still running on d.
+    """
+    day = _day_number(d)
+    i = int(np.searchsorted(index["cstart"], day, side="right")) - 1
+    return not (i >= 0 and index["cend_runmax"][i] >= day)
 
 
-def is_in_uk_on_day(trips: pd.DataFrame, d: date) -> bool:
+@st.cache_data(max_entries=32)
+def compute_signals(app_date: date, cs_bytes: bytes, ce_bytes: bytes) -> tuple[int, int, date, bool]:
     """
-    Under 'whole days abroad', they are abroad on day d iff (leave < d < return).
-    So they are in the UK on d if it is NOT strictly between any leave/return.
+    (days abroad in last 12 months, days abroad in last 5 years, the day 5 years ago, in UK on that day)
+    for one application date. Keyed on the raw _cs/_ce bytes, so reruns triggered by unrelated
+    widgets are a cache hit.
     """
-    for _, r in trips.iterrows():
-        leave = r["start_date"]
-        ret = r["end_date"]
-        if leave < d < ret:
-            return False
-    return True
+    index = build_absence_index(np.frombuffer(cs_bytes, dtype="int32"), np.frombuffer(ce_bytes, dtype="int32"))
+
+    # Windows using exact "1 year ago" / "5 years ago" calendar logic
+    five_years_ago_day = years_ago(app_date, 5)
+    abs_12m, abs_5y = count_absences_in_windows(index, (one_year_ago(app_date), five_years_ago_day), app_date)
+
+    # Presence 5 years ago (same calendar day)
+    present_5y_ago = is_in_uk_on_day(index, five_years_ago_day)
+    return abs_12m, abs_5y, five_years_ago_day, present_5y_ago
 
 
 def tick(ok: bool) -> str:
@@ -200,8 +313,11 @@ def build_credentials() -> Credentials | None:
     return None
 
 
-@st.cache_data(ttl=60)
-def load_trips_df(sheet_id: str, tab_name: str) -> pd.DataFrame:
+@st.cache_resource
+def _gspread_client() -> gspread.Client:
+    """
+    Built once per process: loading the service-account key and authorizing isn't free.
+    """
     creds = build_credentials()
     if creds is None:
         raise RuntimeError(
@@ -209,16 +325,115 @@ def load_trips_df(sheet_id: str, tab_name: str) -> pd.DataFrame:
             "In Streamlit Cloud: set Secrets with a [gcp_service_account] block (recommended) "
             "or set env var GCP_SERVICE_ACCOUNT_JSON."
         )
+    return gspread.authorize(creds)
 
-    gc = gspread.authorize(creds)
-    ws = gc.open_by_key(sheet_id).worksheet(tab_name)
-    values = ws.get_all_values()
 
+# Column dtypes every trips DataFrame has, so the kernels never need per-row type checks
+TRIPS_DTYPES = {
+    "start_date": "datetime64[s]",
+    "end_date": "datetime64[s]",
+    "note": "category",
+    "days_absent": "int32",
+    "_cs": "int32",
+    "_ce": "int32",
+}
+
+
+# Raw sheet values are cached in-process and on disk (so fresh workers / redeploys skip the API round-trip)
+SHEET_CACHE_TTL = 60  # seconds
+SHEET_CACHE_DIR = Path.home() / ".cache" / "ari-app"
+
+
+def _sheet_cache_path(sheet_id: str, tab_name: str) -> Path:
+    key = hashlib.sha256(f"{sheet_id}\0{tab_name}\0{SHEET_RANGE}".encode()).hexdigest()[:16]
+    return SHEET_CACHE_DIR / f"values-{key}.json"
+
+
+def _fresh_cache_mtime(path: Path) -> int | None:
+    """
+    mtime (ns) of the on-disk copy if it is younger than SHEET_CACHE_TTL, else None.
+    """
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    if time.time() - stat.st_mtime >= SHEET_CACHE_TTL:
+        return None
+    return stat.st_mtime_ns
+
+
+@st.cache_data(max_entries=8)
+def _read_cached_values(path: str, mtime_ns: int) -> tuple[tuple, ...] | None:
+    """
+    Keyed on the file's mtime, so the JSON is only re-read after a fetch rewrote it.
+    """
+    try:
+        return tuple(tuple(r) for r in json.loads(Path(path).read_text(encoding="utf-8")))
+    except (OSError, ValueError):
+        # Unreadable or corrupt cache file: just refetch
+        return None
+
+
+def _write_cached_values(path: Path, values: tuple[tuple, ...]) -> None:
+    tmp_name = None
+    try:
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # One temp file per writer, then an atomic rename. NamedTemporaryFile creates it 0600,
+        # which matters here: the file holds personal travel history.
+        with tempfile.NamedTemporaryFile(
+            "w", dir=path.parent, prefix=path.stem, suffix=".tmp", delete=False, encoding="utf-8"
+        ) as f:
+            tmp_name = f.name
+            json.dump(values, f)
+        os.replace(tmp_name, path)
+    except OSError:
+        # Read-only filesystem etc.: the in-process cache still works
+        if tmp_name:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_name)
+
+
+def _fetch_values(sheet_id: str, tab_name: str) -> tuple[tuple, ...]:
+    """
+    Sheet values no older than SHEET_CACHE_TTL: the on-disk copy if a recent fetch
+    (from any worker) wrote one, otherwise this process's cached fetch.
+    """
+    path = _sheet_cache_path(sheet_id, tab_name)
+    mtime_ns = _fresh_cache_mtime(path)
+    values = _read_cached_values(str(path), mtime_ns) if mtime_ns is not None else None
+    if values is None:
+        values = _fetch_values_from_sheet(sheet_id, tab_name)
+    return values
+
+
+@st.cache_data(ttl=SHEET_CACHE_TTL)
+def _fetch_values_from_sheet(sheet_id: str, tab_name: str) -> tuple[tuple, ...]:
+    gc = _gspread_client()
+    ws = gc.open_by_key(sheet_id).worksheet(tab_name)
+    # Unformatted values: dates arrive as serial numbers, not display strings we'd have to re-parse
+    values = ws.get(
+        SHEET_RANGE,
+        value_render_option=ValueRenderOption.unformatted,
+        date_time_render_option=DateTimeOption.serial_number,
+    )
+    values = tuple(tuple(r) for r in values)
+    # Only written on a real fetch, so the file's mtime is the age of the data in it
+    _write_cached_values(_sheet_cache_path(sheet_id, tab_name), values)
+    return values
+
+
+@st.cache_data(max_entries=8)
+def _parse_trips(values: tuple[tuple, ...]) -> pd.DataFrame:
+    """
+    Keyed on the raw sheet values, so a refetch that returns the same cells skips parsing.
+    """
     if not values or len(values) < 2:
-        return pd.DataFrame(columns=["start_date", "end_date", "note", "days_absent"])
+        return pd.DataFrame(columns=list(TRIPS_DTYPES)).astype(TRIPS_DTYPES)
 
-    header = [h.strip() for h in values[0]]
-    rows = values[1:]
+    header = [str(h).strip() for h in values[0]]
+    # The API drops trailing empty cells, so pad (or trim) every row to the header width
+    width = len(header)
+    rows = [list(r[:width]) + [""] * (width - len(r)) for r in values[1:]]
     df = pd.DataFrame(rows, columns=header)
 
     col_map = {c.lower().strip(): c for c in df.columns}
@@ -227,7 +442,10 @@ def load_trips_df(sheet_id: str, tab_name: str) -> pd.DataFrame:
     note_col = col_map.get("note")
 
     if not start_col or not end_col:
-        raise ValueError("Sheet tab must have columns named: start_date, end_date (and optional note).")
+        raise ValueError(
+            "Sheet tab must have columns named: start_date, end_date (and optional note) "
+            f"within columns {SHEET_RANGE} (set GOOGLE_SHEET_RANGE to change)."
+        )
 
     df = df.rename(columns={start_col: "start_date", end_col: "end_date"})
     if note_col:
@@ -235,16 +453,59 @@ def load_trips_df(sheet_id: str, tab_name: str) -> pd.DataFrame:
     else:
         df["note"] = ""
 
-    df["start_date"] = df["start_date"].apply(safe_parse_date)
-    df["end_date"] = df["end_date"].apply(safe_parse_date)
-    df["note"] = df["note"].fillna("").astype(str)
+    # Kept as datetime64 columns (not Python date objects) so downstream math stays vectorized
+    df["start_date"] = parse_date_series(df["start_date"])
+    df["end_date"] = parse_date_series(df["end_date"])
+    # Notes repeat a lot ("holiday", "work trip"), so store them as categories
+    df["note"] = df["note"].fillna("").astype(str).astype("category")
+
+    # Invalid/missing dates are dropped here, so everything downstream can assume valid datetime64 values
+    df = df.dropna(subset=["start_date", "end_date"])
+    in_range = df["start_date"].between(MIN_TRIP_DATE, MAX_TRIP_DATE) & df["end_date"].between(
+        MIN_TRIP_DATE, MAX_TRIP_DATE
+    )
+    df = df[in_range].copy()
 
-    df = df.dropna(subset=["start_date", "end_date"]).copy()
+    # Oldest first: the absence index relies on this order; the UI shows a reversed view
+    df = df.sort_values("start_date", ascending=True, kind="stable").reset_index(drop=True)
 
-    # Latest first
-    df = df.sort_values("start_date", ascending=False).reset_index(drop=True)
+    df["days_absent"] = _to_int32(whole_days_abroad(df["start_date"], df["end_date"]))
 
-    df["days_absent"] = df.apply(lambda r: whole_days_abroad(r["start_date"], r["end_date"]), axis=1)
+    # Countable interval per trip (leave+1 ... return-1) as int32 day numbers for the absence kernels
+    df["_cs"], df["_ce"] = countable_interval(df["start_date"], df["end_date"])
+    return df[list(TRIPS_DTYPES)].astype(TRIPS_DTYPES)
+
+
+def _range_column_span(cell_range: str) -> int | None:
+    """
+    Number of columns an A1 range like "A:C" or "B2:F100" covers; None if it isn't that shape.
+    """
+    m = re.fullmatch(r"\s*([A-Za-z]+)\d*\s*:\s*([A-Za-z]+)\d*\s*", cell_range)
+    if not m:
+        return None
+
+    def col_number(letters: str) -> int:
+        n = 0
+        for ch in letters.upper():
+            n = n * 26 + ord(ch) - ord("A") + 1
+        return n
+
+    return col_number(m.group(2)) - col_number(m.group(1)) + 1
+
+
+def load_trips_df(sheet_id: str, tab_name: str) -> pd.DataFrame:
+    values = _fetch_values(sheet_id, tab_name)
+    df = _parse_trips(values)
+
+    # note is optional, but when the header runs right up to the edge of SHEET_RANGE
+    # a note column may just be cut off, so say so instead of showing blank notes
+    header = [str(h).strip().lower() for h in values[0]] if values else []
+    span = _range_column_span(SHEET_RANGE)
+    if "note" not in header and span is not None and len(header) >= span:
+        st.warning(
+            f"No 'note' column found in columns {SHEET_RANGE}; trip notes are shown blank. "
+            "Set GOOGLE_SHEET_RANGE to include it if it lives further right."
+        )
     return df
 
 
@@ -281,17 +542,11 @@ except Exception as e:
     st.error(str(e))
     st.stop()
 
-# Windows using exact "1 year ago" / "5 years ago" calendar logic
-window_end = app_date
-window_12m_start = one_year_ago(app_date)
-window_5y_start = years_ago(app_date, 5)
-
-abs_12m = count_absences_in_window(trips_df, window_12m_start, window_end)
-abs_5y = count_absences_in_window(trips_df, window_5y_start, window_end)
-
-# Presence 5 years ago (same calendar day)
-five_years_ago_day = years_ago(app_date, 5)
-present_5y_ago = is_in_uk_on_day(trips_df, five_years_ago_day)
+abs_12m, abs_5y, five_years_ago_day, present_5y_ago = compute_signals(
+    app_date,
+    trips_df["_cs"].to_numpy(dtype="int32").tobytes(),
+    trips_df["_ce"].to_numpy(dtype="int32").tobytes(),
+)
 
 OK_12M = abs_12m <= 90
 OK_5Y = abs_5y <= 450
@@ -313,9 +568,15 @@ st.markdown(
 st.divider()
 st.subheader("Trips (latest first)")
 
-show = trips_df[["start_date", "end_date", "days_absent", "note"]].copy()
-show["start_date"] = show["start_date"].apply(uk_fmt)
-show["end_date"] = show["end_date"].apply(uk_fmt)
+latest_first = trips_df.iloc[::-1]
+show = pd.DataFrame(
+    {
+        "start_date": latest_first["start_date"].dt.strftime("%d/%m/%Y"),
+        "end_date": latest_first["end_date"].dt.strftime("%d/%m/%Y"),
+        "days_absent": latest_first["days_absent"],
+        "note": latest_first["note"].astype(str),
+    }
+)
 
 st.dataframe(show, width="stretch", hide_index=True)
 